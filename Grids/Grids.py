@@ -8,6 +8,8 @@ from datetime import timedelta
 import gzip
 import subprocess
 import glob
+import tempfile
+import weakref
 
 # requirements
 import pandas as pd
@@ -21,7 +23,7 @@ import yaml
 
 # local
 from Grids.config import config
-from Grids.utils import log_decorator
+from Grids.utils import log_decorator, file_lock, writer_id
 
 LOGGER = logging.getLogger(__name__)
 LD = log_decorator(LOGGER)
@@ -46,6 +48,15 @@ class Grids:
     config : dict
         Configuration file for projects with their bounds (xmin,ymin,xmax,ymax)
         used for clipping
+    dtype : str
+        In memory dtype of the data layer.  `None` decodes with xarray's
+        default mask/scale (float64 with NaN).  `"float32"` decodes to
+        float32 with NaN, which is lossy: values above about 64 can write
+        a different fifth decimal to the `%.5f` ascii output, and a
+        warning says how many cells do.  `"native"` keeps the source dtype
+        with `_FillValue` marking missing cells and only scales each
+        clipped grid to float64 when writing ascii, so its output is
+        identical to `None`. (the default is None).
 
     Examples
     -------
@@ -58,10 +69,20 @@ class Grids:
     dataset : xarray.core.dataset.Dataset
         Opened netcdf file as xarray dataset
     config
+    temp_dir : str
+        This instance's directory under `temp` for downloads, unzipped and
+        warped netcdf files and ascii grids, so parallel runs never share
+        or delete each other's temporary files.  It is removed by `close`
+        or when the instance is garbage collected.
 
     """
 
-    def __init__(self, config=config, verbose=True):
+    DTYPES = (None, "float32", "native")
+
+    def __init__(self, config=config, verbose=True, dtype=None):
+        if dtype not in self.DTYPES:
+            raise ValueError(f"dtype must be one of {self.DTYPES}, got {dtype}")
+        self.dtype = dtype
         if verbose:
             logging.basicConfig(stream=sys.stderr, level=logging.DEBUG, format=FORMAT)
         else:
@@ -69,6 +90,18 @@ class Grids:
         self.config = config
         self.dataset = None
         self.pathname = None
+        os.makedirs("temp", exist_ok=True)
+        self.temp_dir = tempfile.mkdtemp(prefix=f"{writer_id()}.", dir="temp")
+        self._remove_temp_dir = weakref.finalize(
+            self, shutil.rmtree, self.temp_dir, ignore_errors=True
+        )
+
+    def close(self):
+        """Close the dataset and remove `self.temp_dir`.
+        """
+        if self.dataset:
+            self.dataset.close()
+        self._remove_temp_dir()
 
     @LD
     def set_dataset(
@@ -93,7 +126,7 @@ class Grids:
             self.dataset.close()
         if pathname[-2:] == "gz":
             if not unzipped_dir:
-                unzipped_dir = "temp"
+                unzipped_dir = self.temp_dir
             pathname = self.unzip(
                 pathname, unzipped_dir=unzipped_dir, remove_old=remove_old
             )
@@ -101,11 +134,92 @@ class Grids:
             data_layer = pathname.split(".")[0][-3:]
         self.data_layer = data_layer
         self.pathname = pathname
-        self.dataset = xr.open_dataset(pathname)
-        self._FillValue = self.dataset[self.data_layer].encoding["_FillValue"]
+        self.dataset = self._open(pathname)
+        self._FillValue = self._fill_value(self.dataset[self.data_layer])
         self.year = year
         self.month = month
 
+    def _open(self, pathname):
+        """Open a netcdf file and decode the data layer according to `self.dtype`.
+        """
+        if not self.dtype:
+            return xr.open_dataset(pathname)
+        dataset = xr.open_dataset(pathname, mask_and_scale=False)
+        return self._decode(dataset, self.data_layer)
+
+    def _decode(self, dataset, data_layer):
+        """Decode `data_layer` of a dataset opened with `mask_and_scale=False`.
+
+        `"native"` leaves the raw values and attributes alone.  `"float32"`
+        masks and scales into float32 one time step at a time, checking
+        each step against a float64 decode rounded as the `%.5f` ascii
+        output is, and moves the packing attributes to encoding so
+        `to_netcdf` writes the source dtype back out.
+        """
+        if self.dtype != "float32":
+            return dataset
+        da = dataset[data_layer]
+        attrs = dict(da.attrs)
+        encoding = dict(da.encoding)
+        for key in ["_FillValue", "scale_factor", "add_offset"]:
+            if key in attrs:
+                encoding[key] = attrs.pop(key)
+        encoding["dtype"] = da.dtype
+        fill = encoding.get("_FillValue")
+        scale = np.float64(encoding.get("scale_factor", 1))
+        offset = np.float64(encoding.get("add_offset", 0))
+
+        raw = da.values
+        values = np.empty(raw.shape, dtype=np.float32)
+        differ = 0
+        for idx in range(raw.shape[0]):
+            step = raw[idx].astype(np.float64)
+            if fill is not None:
+                step[raw[idx] == fill] = np.nan
+            step = step * scale + offset
+            values[idx] = step
+            expected = np.round(step, 5)
+            written = np.round(values[idx].astype(np.float64), 5)
+            differ += np.count_nonzero(
+                (expected != written) & ~(np.isnan(expected) & np.isnan(written))
+            )
+        if differ:
+            LOGGER.warning(
+                f"{differ} float32 {data_layer} cells write differently "
+                f"to %.5f ascii than float64"
+            )
+        dataset[data_layer] = xr.Variable(da.dims, values, attrs, encoding)
+        return dataset
+
+    def _fill_value(self, da):
+        """`_FillValue` of a data layer, which is only in attrs if not decoded.
+        """
+        if self.dtype == "native":
+            return da.attrs["_FillValue"]
+        return da.encoding["_FillValue"]
+
+    def _missing(self, grid):
+        """Boolean mask of missing cells in `grid`.
+        """
+        if self.dtype == "native" and np.issubdtype(grid.dtype, np.integer):
+            return grid == self._FillValue
+        missing = np.isnan(grid)
+        if self.dtype == "native":
+            missing |= grid == self._FillValue
+        return missing
+
+    def _unpack(self, grid, attrs):
+        """Mask and scale a `"native"` grid to float64 for ascii output.
+            Casting before scaling keeps float32 `scale_factor`/`add_offset`
+            attributes from scaling in float32.
+        """
+        missing = self._missing(grid)
+        scale = np.float64(attrs.get("scale_factor", 1))
+        offset = np.float64(attrs.get("add_offset", 0))
+        grid = grid.astype(np.float64) * scale + offset
+        grid[missing] = np.nan
+        return grid
+
     @LD
     def get_grid(
         self,
@@ -132,7 +246,7 @@ class Grids:
         set_dataset : boolean
             Open file and set as xarray dataset (the default is True).
         unzipped_dir : str
-            Directory to unzip if `set_dataset=True`.  `"temp"` is used
+            Directory to unzip if `set_dataset=True`.  `self.temp_dir` is used
             if not provided.
         force : boolean
             Download data even if found locally.
@@ -162,13 +276,13 @@ class Grids:
             url = f"https://www.nwrfc.noaa.gov/weather/netcdf/{year}/{date}/{fname}"
             LOGGER.info(f"No local copy, attempting to get data {url}")
             try:
-                raw_data = wget.download(url)
+                raw_data = wget.download(url, out=self.temp_dir)
             except Exception as e:
                 LOGGER.error(f"Fatal error in wget for {url}")
                 raise e
             LOGGER.info(f"Success, retrieved {raw_data} moving to {directory}")
             try:
-                shutil.move(raw_data, os.path.join(directory, raw_data))
+                shutil.move(raw_data, os.path.join(directory, fname))
             except Exception as e:
                 LOGGER.error(f"Could not move file {raw_data}")
                 raise e
@@ -189,7 +303,7 @@ class Grids:
         """Utility function to unzip files.
         """
         if remove_old:
-            for f in glob.glob("temp/*.nc"):
+            for f in glob.glob(os.path.join(unzipped_dir, "*.nc")):
                 os.remove(f)
         f = gzip.GzipFile(f"{pathname}", "rb")
         s = f.read()
@@ -216,7 +330,7 @@ class Grids:
         Parameters
         ----------
         destNameOrDestDS : str
-            Destination output file path.  Will put file in `temp` if
+            Destination output file path.  Will put file in `self.temp_dir` if
             `destNameOrDestDS=None`
         dstSRS : str
             Spatial Reference system to warp the data to.  
@@ -250,7 +364,9 @@ class Grids:
         srcNodata = self._FillValue
         srcDSOrSrcDSTab = gdal.Open(f'NETCDF:"{self.pathname}":{self.data_layer}')
         if not destNameOrDestDS:
-            destNameOrDestDS = os.path.join("temp", f"{self.data_layer}.temp.nc")
+            destNameOrDestDS = os.path.join(
+                self.temp_dir, f"{self.data_layer}.temp.nc"
+            )
 
         LOGGER.info(f"Attempting to warp {self.pathname}")
         try:
@@ -281,10 +397,14 @@ class Grids:
         # cannot maintain the 3d architecture (x,y,time) only can do 2d (x,y)
         # so I am concatenating the new file here and setting it to my dataset to maintain the
         # original architecture
-        warped = xr.open_dataset(destNameOrDestDS)
+        if self.dtype:
+            warped = xr.open_dataset(destNameOrDestDS, mask_and_scale=False)
+        else:
+            warped = xr.open_dataset(destNameOrDestDS)
         time = self.dataset["time"]
         bands = [warped[f"Band{b}"] for b in range(1, len(time) + 1)]
         warped[self.data_layer] = xr.concat(bands, time)
+        warped = self._decode(warped, self.data_layer)
         self.dataset.close()
         self.dataset = warped.drop_vars([f"Band{b}" for b in range(1, len(time) + 1)])
         warped.close()
@@ -361,7 +481,7 @@ class Grids:
         return start_time, end_time
 
     @LD
-    def clip_to_dss(self, project, dss_paths="both"):
+    def clip_to_dss(self, project, dss_paths="both", shards=None):
         """Clip dataset and store in dss file given 
             a project name located in config.
 
@@ -371,6 +491,13 @@ class Grids:
         ----------
         project : str
             Project name located in `self.config`.
+        dss_paths : str or list
+            `"both"`, `"project"`, `"datatype"` or a list of dss files
+            (the default is "both").
+        shards : Grids.dss.DssShards
+            Add records to this writer's shard for `Grids.dss.consolidate`
+            instead of writing the dss files.  Without shards each dss file
+            is locked while it is written. (the default is None).
 
         Examples
         -------
@@ -410,15 +537,23 @@ class Grids:
             dtype = "INST-VAL"
             units = '"DEG F"'
 
+        attrs = self.dataset[self.data_layer].attrs
         for idx, time in enumerate(self.dataset["time"].values):
             start_time, end_time = self.get_times(time, dtype=dtype)
 
             dss_path = f"/SHG/{project}/{data_type}/{start_time}/{end_time}/RFC-{self.data_layer}/"
             grid = clipped[idx]
-            if np.all(np.isnan(grid)):
+            if np.all(self._missing(grid)):
                 LOGGER.warning(f"Missing data for {dss_path}")
                 continue
-            asc_pathname = os.path.join("temp", f"{self.data_layer}_temp.asc")
+            if self.dtype == "native":
+                grid = self._unpack(grid, attrs)
+            if shards:
+                asc_pathname = shards.asc_pathname()
+            else:
+                asc_pathname = os.path.join(
+                    self.temp_dir, f"{self.data_layer}_temp.asc"
+                )
 
             dss_pathname = os.path.join(
                 "data", f"NWD_{self.data_layer}.{self.year}.{self.month}.dss"
@@ -438,20 +573,32 @@ class Grids:
             self._to_esri_ascii(
                 grid, asc_pathname, xllcorner, yllcorner, self.cellsize, self._FillValue
             )
-            for dss_pathname in dss_pathnames:
-                self.asc2dssGrid(dss_pathname, asc_pathname, dss_path, units, dtype)
+            if shards:
+                shards.add(asc_pathname, dss_pathnames, dss_path, units, dtype)
+                continue
+            try:
+                for dss_pathname in dss_pathnames:
+                    with file_lock(dss_pathname):
+                        self.asc2dssGrid(
+                            dss_pathname, asc_pathname, dss_path, units, dtype
+                        )
+            finally:
+                os.remove(asc_pathname)
 
     @staticmethod
     @LD
-    def asc2dssGrid(dss_pathname, asc_pathname, dss_path, units, dtype):
+    def asc2dssGrid(dss_pathname, asc_pathname, dss_path, units, dtype, check=False):
+        """Write an esri ascii grid to a dss file with asc2dssGrid.
+            `check=True` raises a CalledProcessError if asc2dssGrid fails.
+        """
         # asc2dssGrid = os.path.join(cwms_dir, "common", "grid", "asc2dssGrid")
         cmd = f" in={asc_pathname} dss={dss_pathname} path={dss_path} grid=SHG dunits={units} dtype={dtype}"
         LOGGER.info(f"Attemptinfrom Grids to run: {cmd}")
         try:
             if os.name == "nt":
-                subprocess.run(f"asc2DssGrid {cmd}")
+                subprocess.run(f"asc2DssGrid {cmd}", check=check)
             else:
-                subprocess.run(f"./asc2dssGrid.sh {cmd}", shell=True)
+                subprocess.run(f"./asc2dssGrid.sh {cmd}", shell=True, check=check)
             LOGGER.info(f"{dss_path} written to {dss_pathname}")
         except Exception as e:
             LOGGER.error(f"Fatal error in {cmd}", exc_info=True)
@@ -467,20 +614,42 @@ class Grids:
         start_times = times.hour == 18
         idxs = [i for i, x in enumerate(start_times) if x]
         for idx in idxs:
-            dataset = self.dataset.sel(
-                dict(time=self.dataset["time"].values[idx : idx + 4])
-            )
+            # isel with a slice returns views rather than copies
+            dataset = self.dataset.isel(time=slice(idx, idx + 4))
             grid = dataset[self.data_layer].values
-            if np.all(np.isnan(grid)):
+            if np.all(self._missing(grid)):
                 LOGGER.warning(f"Missing data for {times[idx]}")
                 continue
             date = (times[idx] + timedelta(days=1)).strftime("%Y%m%d")
-            path = os.path.join(dir, f"{self.data_layer}.{date}12.nc")
+            fname = f"{self.data_layer}.{date}12.nc"
+            path = os.path.join(self.temp_dir, fname)
+            # gzip to a temp file and rename so other processes splitting or
+            # reading the same day never see a partial file
+            gz_path = os.path.join(dir, f"{fname}.gz")
+            temp_gz_path = f"{gz_path}.{writer_id()}.tmp"
             dataset.to_netcdf(path=path)
-            with open(path, "rb") as f_in, gzip.open(f"{path}.gz", "wb") as f_out:
+            with open(path, "rb") as f_in, gzip.open(temp_gz_path, "wb") as f_out:
                 f_out.writelines(f_in)
+            os.replace(temp_gz_path, gz_path)
             os.remove(path)
 
+    @staticmethod
+    def _check_packing(datasets, data_layer):
+        """Raw values can only be combined if they are packed the same way.
+        """
+        packing = {
+            tuple(
+                d[data_layer].attrs.get(key)
+                for key in ["_FillValue", "scale_factor", "add_offset"]
+            )
+            for d in datasets
+        }
+        if len(packing) > 1:
+            raise ValueError(
+                f"Cannot combine {data_layer} with dtype='native', grids are packed "
+                f"differently {packing}, use dtype='float32'"
+            )
+
     @LD
     def blend(self, data_type, lookback=10, force=False):
 
@@ -519,6 +688,8 @@ class Grids:
                     dataset.rename({data_type + "F": new_layer_name})
                 )
         dataset_list = None
+        if self.dtype == "native":
+            self._check_packing(new_dataset_list, new_layer_name)
 
         self.dataset = xr.auto_combine(new_dataset_list)
         self.data_layer = new_layer_name
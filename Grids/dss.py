@@ -0,0 +1,163 @@
+# standard packages
+import logging
+import os
+import json
+import glob
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+# local
+from Grids.Grids import Grids
+from Grids.utils import log_decorator, file_lock, writer_id
+
+LOGGER = logging.getLogger(__name__)
+LD = log_decorator(LOGGER)
+
+
+class DssShards:
+    """Per writer shard of DSS records so parallel writers never touch
+        a shared dss file.  Records are kept as esri ascii grids plus a
+        manifest and written to their dss files by `consolidate`.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding every writer's shard (the default is "temp/shards").
+    writer : str
+        Name of this writer's shard, which must not exist yet.  Host name,
+        process id and a random suffix are used if `writer=None`.
+
+    Examples
+    -------
+    >>> shards = DssShards()
+    >>> g = Grids()
+    >>> g.get_grid("QPE")
+    >>> g.warp()
+    >>> g.clip_to_dss("kootenai", shards=shards)
+    >>> shards.close()
+    >>> consolidate()
+
+    """
+
+    def __init__(self, directory=os.path.join("temp", "shards"), writer=None):
+        if not writer:
+            writer = f"{writer_id()}.{uuid.uuid4().hex}"
+        self.directory = os.path.join(directory, writer)
+        # never resume a shard, it may already be finished and consolidating
+        os.makedirs(self.directory, exist_ok=False)
+        self.manifest = os.path.join(self.directory, "manifest.jsonl")
+        self.count = 0
+
+    def asc_pathname(self):
+        """Path for the next record's esri ascii grid.
+        """
+        return os.path.join(self.directory, f"{self.count:06d}.asc")
+
+    def add(self, asc_pathname, dss_pathnames, dss_path, units, dtype):
+        """Record that `asc_pathname` goes to `dss_path` in each of `dss_pathnames`.
+        """
+        record = dict(
+            asc_pathname=asc_pathname,
+            dss_pathnames=dss_pathnames,
+            dss_path=dss_path,
+            units=units,
+            dtype=dtype,
+        )
+        with open(self.manifest, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.count += 1
+
+    def close(self):
+        """Mark the shard finished so `consolidate` can pick it up.
+        """
+        open(os.path.join(self.directory, "done"), "w").close()
+
+
+@LD
+def consolidate(directory=os.path.join("temp", "shards"), workers=4):
+    """Write every finished shard in `directory` to its dss files.
+        Each dss file is written by one thread holding its file lock, so
+        different dss files are written in parallel while writers on
+        other hosts or processes wait their turn on shared files.
+        A shard is claimed by holding a file lock on it, which the OS
+        releases if consolidate is killed, and is only removed once all
+        of its records are written.  Otherwise it is left for the next
+        consolidate and a RuntimeError is raised.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding every writer's shard (the default is "temp/shards").
+    workers : int
+        Number of dss files to write at once (the default is 4).
+    """
+    with ExitStack() as locks:
+        claimed = []
+        for shard in sorted(glob.glob(os.path.join(directory, "*", ""))):
+            shard = os.path.dirname(shard)
+            if not os.path.exists(os.path.join(shard, "done")):
+                continue
+            try:
+                locks.enter_context(file_lock(shard, timeout=0))
+            except TimeoutError:
+                continue
+            # another consolidate may have finished it while we waited
+            if os.path.exists(os.path.join(shard, "done")):
+                claimed.append(shard)
+
+        failed = set()
+        targets = {}
+        for shard in claimed:
+            manifest = os.path.join(shard, "manifest.jsonl")
+            if not os.path.exists(manifest):
+                continue
+            with open(manifest) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        LOGGER.error(f"Corrupt record in {shard}: {line!r}")
+                        failed.add(shard)
+                        continue
+                    for dss_pathname in record["dss_pathnames"]:
+                        targets.setdefault(dss_pathname, []).append((shard, record))
+
+        def write(dss_pathname):
+            """Write a dss file's records, returning the shards of any not written.
+            """
+            records = targets[dss_pathname]
+            written = 0
+            try:
+                with file_lock(dss_pathname):
+                    for shard, record in records:
+                        Grids.asc2dssGrid(
+                            dss_pathname,
+                            record["asc_pathname"],
+                            record["dss_path"],
+                            record["units"],
+                            record["dtype"],
+                            check=True,
+                        )
+                        written += 1
+            except Exception:
+                LOGGER.error(f"Fatal error writing {dss_pathname}", exc_info=True)
+            return {shard for shard, record in records[written:]}
+
+        LOGGER.info(f"Consolidating {len(claimed)} shards to {len(targets)} dss files")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            failed = failed.union(*executor.map(write, targets))
+        finished = [shard for shard in claimed if shard not in failed]
+        for shard in finished:
+            shutil.rmtree(shard)
+    # locks are released, nothing will use these shards' lock files again
+    for shard in finished:
+        try:
+            os.remove(f"{shard}.lock")
+        except OSError:
+            continue
+    if failed:
+        raise RuntimeError(
+            f"Could not consolidate {len(failed)} shards, they are left for a retry"
+        )
@@ -1,5 +1,15 @@
 import functools
 from functools import wraps
+from contextlib import contextmanager
+import os
+import socket
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 
 def log_decorator(logger, level=10):
@@ -15,3 +25,81 @@ def log_decorator(logger, level=10):
         return wrapper
 
     return real_decorator
+
+
+def writer_id():
+    """Name unique to this process across hosts sharing the data directory.
+    """
+    return f"{socket.gethostname()}.{os.getpid()}"
+
+
+@contextmanager
+def file_lock(pathname, timeout=600, poll=0.1):
+    """Exclusive lock on `pathname` held as an OS advisory lock on a
+        `{pathname}.lock` file (flock on posix, msvcrt.locking on windows).
+        The OS releases the lock if the holding process dies, so a killed
+        writer never leaves a stale lock behind.
+
+    Parameters
+    ----------
+    pathname : str
+        File to lock, it does not need to exist.
+    timeout : int
+        Seconds to wait for the lock before raising a TimeoutError
+        (the default is 600).
+    poll : float
+        Seconds between attempts (the default is 0.1).
+    """
+    lock = f"{pathname}.lock"
+    # the lock file is left in place, removing it would let another
+    # process lock a new file while a waiter still holds the old one
+    f = open(lock, "a+")
+    start = time.monotonic()
+    try:
+        while True:
+            try:
+                _lock(f)
+                break
+            except OSError:
+                if time.monotonic() - start > timeout:
+                    raise TimeoutError(
+                        f"Could not lock {pathname} in {timeout}s, "
+                        f"held by {_holder(f)}"
+                    )
+                time.sleep(poll)
+        f.seek(0)
+        f.truncate()
+        f.write(writer_id())
+        f.flush()
+        try:
+            yield
+        finally:
+            _unlock(f)
+    finally:
+        f.close()
+
+
+def _lock(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+
+
+def _unlock(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _holder(f):
+    """Writer id stored in a lock file, windows will not read a locked byte.
+    """
+    try:
+        f.seek(0)
+        return f.read()
+    except OSError:
+        return "another process"
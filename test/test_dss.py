@@ -0,0 +1,131 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from Grids.Grids import Grids
+from Grids.dss import DssShards, consolidate
+from Grids.utils import file_lock
+
+
+def test_file_lock(tmp_path):
+    pathname = str(tmp_path / "NWD_QPE.2020.04.dss")
+    with file_lock(pathname):
+        with pytest.raises(TimeoutError):
+            with file_lock(pathname, timeout=0.2):
+                pass
+    with file_lock(pathname, timeout=0.2):
+        pass
+
+
+def test_file_lock_killed_holder(tmp_path):
+    pathname = str(tmp_path / "NWD_QPE.2020.04.dss")
+    holder = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import sys, time\n"
+            "from Grids.utils import file_lock\n"
+            f"with file_lock({pathname!r}):\n"
+            "    print('locked', flush=True)\n"
+            "    time.sleep(60)\n",
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    assert holder.stdout.readline().strip() == "locked"
+    with pytest.raises(TimeoutError):
+        with file_lock(pathname, timeout=0.2):
+            pass
+    holder.kill()
+    holder.wait()
+    # the OS released the dead process's lock
+    with file_lock(pathname, timeout=5):
+        pass
+
+
+def test_consolidate(tmp_path, monkeypatch):
+    written = []
+
+    def asc2dssGrid(dss_pathname, asc_pathname, dss_path, units, dtype, check=False):
+        assert check
+        assert os.path.exists(f"{dss_pathname}.lock")
+        written.append((dss_pathname, dss_path))
+
+    monkeypatch.setattr(Grids, "asc2dssGrid", staticmethod(asc2dssGrid))
+    directory = str(tmp_path / "shards")
+    shared = str(tmp_path / "NWD_QPE.2020.04.dss")
+    for writer, project in [("a", "kootenai"), ("b", "deschutes")]:
+        shards = DssShards(directory=directory, writer=writer)
+        project_pathname = str(tmp_path / f"NWD_{project}.2020.dss")
+        for hour in ["1200", "1800"]:
+            asc_pathname = shards.asc_pathname()
+            open(asc_pathname, "w").close()
+            dss_path = f"/SHG/{project}/PRECIP/21APR2020:{hour}//RFC-QPE/"
+            shards.add(
+                asc_pathname, [shared, project_pathname], dss_path, "MM", "PER-CUM"
+            )
+        if writer == "a":
+            shards.close()
+
+    consolidate(directory=directory, workers=2)
+    # only the closed shard is consolidated, in the order it was written
+    assert sorted(set(w[0] for w in written)) == sorted(
+        [shared, str(tmp_path / "NWD_kootenai.2020.dss")]
+    )
+    assert [w[1] for w in written if w[0] == shared] == [
+        "/SHG/kootenai/PRECIP/21APR2020:1200//RFC-QPE/",
+        "/SHG/kootenai/PRECIP/21APR2020:1800//RFC-QPE/",
+    ]
+    assert os.listdir(directory) == ["b"]
+
+
+def test_consolidate_failure(tmp_path, monkeypatch):
+    def asc2dssGrid(dss_pathname, asc_pathname, dss_path, units, dtype, check=False):
+        if "deschutes" in dss_pathname:
+            raise subprocess.CalledProcessError(1, "asc2dssGrid")
+
+    monkeypatch.setattr(Grids, "asc2dssGrid", staticmethod(asc2dssGrid))
+    directory = str(tmp_path / "shards")
+    for writer, project in [("a", "kootenai"), ("b", "deschutes")]:
+        shards = DssShards(directory=directory, writer=writer)
+        asc_pathname = shards.asc_pathname()
+        open(asc_pathname, "w").close()
+        dss_path = f"/SHG/{project}/PRECIP/21APR2020:1200//RFC-QPE/"
+        project_pathname = str(tmp_path / f"NWD_{project}.2020.dss")
+        shards.add(asc_pathname, [project_pathname], dss_path, "MM", "PER-CUM")
+        shards.close()
+
+    with pytest.raises(RuntimeError):
+        consolidate(directory=directory)
+    # the failed shard is left with its records for a retry
+    assert sorted(os.listdir(directory)) == ["b", "b.lock"]
+    assert os.path.exists(os.path.join(directory, "b", "done"))
+    assert os.path.exists(os.path.join(directory, "b", "000000.asc"))
+
+    monkeypatch.setattr(Grids, "asc2dssGrid", staticmethod(lambda *a, **k: None))
+    consolidate(directory=directory)
+    assert os.listdir(directory) == []
+
+
+def test_consolidate_locked_shard(tmp_path, monkeypatch):
+    monkeypatch.setattr(Grids, "asc2dssGrid", staticmethod(lambda *a, **k: None))
+    directory = str(tmp_path / "shards")
+    shards = DssShards(directory=directory, writer="a")
+    shards.close()
+    # a shard locked by another consolidate is skipped, and picked up
+    # again once that consolidate releases it or dies
+    with file_lock(shards.directory):
+        consolidate(directory=directory)
+        assert os.path.exists(os.path.join(shards.directory, "done"))
+    consolidate(directory=directory)
+    assert os.listdir(directory) == []
+
+
+def test_shards_unique(tmp_path):
+    directory = str(tmp_path / "shards")
+    assert DssShards(directory).directory != DssShards(directory).directory
+    DssShards(directory, writer="a").close()
+    with pytest.raises(FileExistsError):
+        DssShards(directory, writer="a")
@@ -1,3 +1,4 @@
+import io
 import os
 import glob
 import sys
@@ -8,23 +9,50 @@ import logging
 
 import pytest
 import pandas as pd
+import numpy as np
+import xarray as xr
 import json
 
 from Grids.Grids import Grids
 
 
+def packed_netcdf(path, x=None, y=None):
+    """Write a small int16 QPE netcdf packed with float32 scale/offset
+    like the NWRFC files, with one missing cell in each time step.
+    """
+    if x is None:
+        x = np.arange(4) * 2000.0
+    if y is None:
+        y = np.arange(3) * 2000.0
+    time = pd.date_range("2020-04-20 18:00", periods=4, freq="6H")
+    shape = (len(time), len(y), len(x))
+    raw = np.arange(np.prod(shape)).reshape(shape) * 257 % 30000 - 100
+    raw = raw.astype(np.int16)
+    raw[:, 0, 0] = -9999
+    attrs = {
+        "_FillValue": np.int16(-9999),
+        "scale_factor": np.float32(0.01),
+        "add_offset": np.float32(0.5),
+        "units": "mm",
+        "grid_mapping": "crs",
+    }
+    ds = xr.Dataset(
+        {"QPE": (("time", "y", "x"), raw, attrs), "crs": ((), np.int32(0))},
+        coords={"time": time, "y": y, "x": x},
+    )
+    ds.to_netcdf(str(path))
+    return str(path)
+
+
 @pytest.fixture()
 def g():
     g = Grids()
     yield g
-    if g.dataset:
-        g.dataset.close()
+    g.close()
     for f in glob.glob("test/temp/*.nc"):
         os.remove(f)
     for f in glob.glob("test/data/*.nc"):
         os.remove(f)
-    for f in glob.glob("temp/*.nc"):
-        os.remove(f)
     for f in glob.glob("raw/*.gz"):
         os.remove(f)
 
@@ -81,6 +109,109 @@ class TestClass(object):
     def test_clip_to_dss(self):
         pass
 
+    def test_dtype_clip_to_dss(self, tmp_path, monkeypatch):
+        path = packed_netcdf(tmp_path / "QPE.2020042112.nc")
+        project = dict(xmin=0, ymin=0, xmax=4000, ymax=2000)
+        outputs = {}
+        for dtype in [None, "float32", "native"]:
+            written = []
+
+            def asc2dssGrid(dss_pathname, asc_pathname, dss_path, units, dtype):
+                with open(asc_pathname) as f:
+                    written.append((dss_path, f.read()))
+
+            monkeypatch.setattr(Grids, "asc2dssGrid", staticmethod(asc2dssGrid))
+            g = Grids(config={"test": project}, dtype=dtype)
+            with self._caplog.at_level(logging.WARNING):
+                g.set_dataset(path, year="2020", month="04", data_layer="QPE")
+            if dtype == "float32":
+                # float32 is lossy in the fifth decimal for values this large
+                assert any(
+                    "write differently" in r.message for r in self._caplog.records
+                )
+            g.cellsize = 2000
+            g.clip_to_dss("test", dss_paths=[str(tmp_path / "NWD_test.dss")])
+            assert not glob.glob(os.path.join(g.temp_dir, "*.asc"))
+            outputs[dtype] = written
+            if dtype == "float32":
+                assert g.dataset["QPE"].dtype == np.float32
+            if dtype == "native":
+                assert g.dataset["QPE"].dtype == np.int16
+            g.close()
+        assert len(outputs[None]) == 4
+        assert outputs[None] == outputs["native"]
+        for (path, expected), (f_path, written) in zip(
+            outputs[None], outputs["float32"]
+        ):
+            assert path == f_path
+            assert expected.splitlines()[:6] == written.splitlines()[:6]
+            np.testing.assert_allclose(
+                np.loadtxt(io.StringIO(written), skiprows=6),
+                np.loadtxt(io.StringIO(expected), skiprows=6),
+                rtol=0,
+                atol=1e-5,
+            )
+
+        with pytest.raises(ValueError):
+            Grids(dtype="float16")
+
+    def test_dtype_split(self, tmp_path):
+        path = packed_netcdf(tmp_path / "QPE.2020042112.nc")
+        g = Grids(dtype="float32")
+        g.set_dataset(path, year="2020", month="04", data_layer="QPE")
+        split_dir = tmp_path / "split"
+        split_dir.mkdir()
+        g._split(dir=str(split_dir))
+        g.close()
+
+        # the split file is packed like the source and decodes the same
+        split = Grids()
+        split.set_dataset(
+            str(split_dir / "QPE.2020042112.nc.gz"),
+            year="2020",
+            month="04",
+            data_layer="QPE",
+            unzipped_dir=str(split_dir),
+            remove_old=False,
+        )
+        expected = Grids()
+        expected.set_dataset(path, year="2020", month="04", data_layer="QPE")
+        assert split.dataset["QPE"].encoding["dtype"] == np.int16
+        np.testing.assert_array_equal(
+            split.dataset["QPE"].values, expected.dataset["QPE"].values
+        )
+        split.close()
+        expected.close()
+
+    def test_dtype_warp(self, tmp_path):
+        path = packed_netcdf(
+            tmp_path / "QPE.2020042112.nc",
+            x=np.linspace(-120, -119, 20),
+            y=np.linspace(45, 46, 20),
+        )
+        grids = {}
+        for dtype in [None, "float32"]:
+            g = Grids(dtype=dtype)
+            g.set_dataset(path, year="2020", month="04", data_layer="QPE")
+            g.warp(destNameOrDestDS=str(tmp_path / f"QPE.{dtype}.temp.nc"))
+            grids[dtype] = g.dataset["QPE"].values
+            g.close()
+        assert grids["float32"].dtype == np.float32
+        np.testing.assert_allclose(grids["float32"], grids[None], rtol=1e-6)
+
+    def test_check_packing(self):
+        raw = np.zeros((1, 2, 2), dtype=np.int16)
+        datasets = [
+            xr.Dataset(
+                {"QPB": (("time", "y", "x"), raw, {"scale_factor": np.float32(s)})}
+            )
+            for s in [0.01, 0.01]
+        ]
+        Grids._check_packing(datasets, "QPB")
+        datasets[1]["QPB"].attrs["scale_factor"] = np.float32(0.1)
+        with pytest.raises(ValueError):
+            Grids._check_packing(datasets, "QPB")
+
     def test_split(self, g):
         hrs = [-6, 0, 6, 12]
 